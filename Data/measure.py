@@ -5,6 +5,26 @@ import matplotlib.pyplot as plt
 import re
 from collections import deque
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+
+# Filenames look like <condition>_<method>.csv
+FILENAME_RE = re.compile(r'^(?P<condition>[^_]+)_(?P<method>.+)\.csv$')
+
+
+def group_by_chrom(chrom_codes, values) -> dict:
+    """
+    Group values by integer chromosome code in a single pass.
+    Parameters:
+        chrom_codes (np.ndarray): Integer chromosome code of every row.
+        values (np.ndarray): Value of every row, e.g. its position.
+    Returns:
+    dict: Maps each chromosome code to a numpy array of its values, in their original order.
+    """
+    order = np.argsort(chrom_codes, kind='stable')
+    codes, starts = np.unique(chrom_codes[order], return_index=True)
+    return dict(zip(codes.tolist(), np.split(values[order], starts[1:])))
 
 
 def comp_within(mutant_df, control_df, dist:int=10) -> pd.DataFrame:
@@ -14,8 +34,9 @@ def comp_within(mutant_df, control_df, dist:int=10) -> pd.DataFrame:
     of the rows in the mutant dataframe with the positions in the control dataframe within a specified distance.
     If a match is found within the distance, the row is removed from the mutant dataframe.
     Parameters:
-        mutant_df (pd.DataFrame): DataFrame containing mutant data with at least 'chrom' and position columns.
-        control_df (pd.DataFrame): DataFrame containing control data with at least 'chrom' and position columns.
+        mutant_df (pd.DataFrame): DataFrame containing mutant data with at least '#CHROM' and position columns.
+            '#CHROM' may be strings or categorical, it is compared as categorical codes either way.
+        control_df (pd.DataFrame): DataFrame containing control data with at least '#CHROM' and position columns.
         dist (int, optional): Distance within which to consider positions as matching. Default is 10.
     Returns:
     pd.DataFrame: The mutant dataframe with matched rows removed.
@@ -28,107 +49,150 @@ def comp_within(mutant_df, control_df, dist:int=10) -> pd.DataFrame:
     #     pos_col = 'left_pos'
     print(f'Control columns: {control_df.columns}')
     print(f'Mutant columns: {mutant_df.columns}')
+    
+    # Pull the columns out as numpy arrays once so the loops don't go through pandas.
+    # The control is put on the mutant's chromosome categories, so both sides share the same int codes.
+    m_chrom = mutant_df['#CHROM'].astype('category')
+    c_chrom = control_df['#CHROM'].astype('category')
+    m_codes = m_chrom.cat.codes.to_numpy()
+    c_codes = c_chrom.cat.set_categories(m_chrom.cat.categories).cat.codes.to_numpy()
+    m_pos = mutant_df.iloc[:, 1].to_numpy()
+    m_idx = mutant_df.index.to_numpy()
+    control_groups = group_by_chrom(c_codes, control_df.iloc[:, 1].to_numpy())
+    # -1 is both a missing chromosome and a control chromosome the mutant doesn't have, neither can match
+    control_groups.pop(-1, None)
+    empty = np.empty(0, dtype=m_pos.dtype)
         
     # Cycle through each chromosome in the mutant dataframe
-    for chrom in mutant_df['#CHROM'].unique():
-        control_df_chrom = control_df[control_df['#CHROM'] == chrom]
+    for chrom, m_rows in group_by_chrom(m_codes, np.arange(m_codes.shape[0])).items():
+        if chrom == -1:
+            continue
+        c_sorted = np.sort(control_groups.get(chrom, empty))
+        m_pos_chr = m_pos[m_rows]
         
-        # Cycle through the rows in the mutant dataframe
-        for i in range(0, mutant_df.shape[0], dist):
-            pos = mutant_df.iloc[i, 1]
-            
-            matched = False
-            j = 0
-            # Cycle through the rows in the control dataframe
-            while (j < control_df_chrom.shape[0]) & (matched == False):
-                pos_2 = control_df_chrom.iloc[j, 1]
-                # Check if the positions match within the specified distance, and if so, add the index to the list
-                if pos - dist <= pos_2 <= pos + dist:
-                    indices_to_drop.append(mutant_df.index[i])
-                    matched = True
-                    
-                j += 1
+        # Sort the mutant positions too, so the search walks forward through the control like a merge
+        m_order = np.argsort(m_pos_chr, kind='stable')
+        m_sorted = m_pos_chr[m_order]
+        
+        # As in a two-pointer sweep, find the first control position at or after the start of each window,
+        # the window matches when that position doesn't run past its end
+        j = np.searchsorted(c_sorted, m_sorted - dist, side='left')
+        matched_sorted = j < c_sorted.shape[0]
+        matched_sorted[matched_sorted] = c_sorted[j[matched_sorted]] <= m_sorted[matched_sorted] + dist
+        
+        matched_mask = np.empty_like(matched_sorted)
+        matched_mask[m_order] = matched_sorted
+        indices_to_drop.extend(m_idx[m_rows][matched_mask])
                 
-    return mutant_df
+    return mutant_df.drop(indices_to_drop)
 
 def compare_between(all_dict, distance:int=10, agreement:int = 2) -> pd.DataFrame:
         """
         Compare positions between different methods and return a combined dataframe.
-        This function iterates through the methods in the dictionary and compares the positions
-        of the rows in the dataframes within a specified distance. If a match is found within the distance
-        in at least the specified number of methods, the row is included in the combined dataframe.
+        This function pools the positions of every method and links any two positions on the same
+        chromosome that are within a specified distance, directly or through other linked positions.
+        If a linked group of positions was called by at least the specified number of methods,
+        the group is included in the combined dataframe as a single row.
         Parameters:
-            all_dict (dict): Dictionary containing dataframes for different methods.
+            all_dict (dict): Dictionary containing dataframes for different methods, each with at least '#CHROM'
+                and 'POS' columns. '#CHROM' may be strings or categorical.
             distance (int, optional): Distance within which to consider positions as matching. Default is 10.
             agreement (int, optional): Minimum number of methods that should agree on a position. Default is 2.
         Returns:
         pd.DataFrame: The combined dataframe with matched rows.
         """
-        consensus = []
-       
         # making a dictionary to remember which column each pos is stored in.
         pos_col_dict = {}
-        i = 1
+        i = 0
         for key in all_dict.keys():
             pos_col_dict[key] = i
             i += 1
         
-        # Cycle every method
-        for curr_method in all_dict:
-            df_keys = list(all_dict.keys())
-            # df_keys.remove(curr_method)
-            leader = all_dict[curr_method]
-            
-            # Cycle every row in the leader
-            for i in range(0, leader.shape[0]):
-                chrom = leader.iloc[i]['#CHROM']
-                pos = leader.iloc[i]['POS']
-                match_row = [-1 for x in range(len(all_dict.keys()) + 2)]
-                count = 0
-                average = 0
-                
-                # Cycle every method
-                for alt_method in df_keys:
-                    matches = all_dict[alt_method]
-                    
-                    # Filter for chromosome matches 
-                    matches = matches[matches['#CHROM'] == chrom]
-                    matches = matches[(matches['POS'] >= pos - distance) & (matches['POS'] <= pos + distance)]
-                    matches['POS'] = matches['POS'].astype(int)
-                
-                    # If there are matches, store the position and update the running sums
-                    if not matches.empty:
-                        storage_pos = pos_col_dict[alt_method]
-                        # store the position
-                        match_row[storage_pos] = tuple(matches['POS'].tolist())
-                        
-                        # update the running sums
-                        average += sum(matches['POS'].tolist())
-                        count += 1
-                
-                # If the count is greater than the agreement, add the row to the consensus
-                if count >= agreement:
-                    # remember the chromosome
-                    match_row[0] = chrom
-                    consensus.append(match_row)
-                    average = average / count
-                    # remember the average
-                    match_row[-1] = int(average)
-                    
+        if not all_dict:
+            return pd.DataFrame(columns=['CHROM', 'AVERAGE'])
         
-        columns = ['CHROM'] + list(pos_col_dict.keys()) + ['AVERAGE']
+        # Encode the chromosomes as integer codes shared by every method, in sorted order of their names.
+        # Only the categories are combined, then each method's codes are remapped through their union,
+        # so the category dtypes don't have to match (e.g. for an empty file). A missing chromosome stays -1.
+        methods = list(all_dict.keys())
+        chroms = [all_dict[method]['#CHROM'].astype('category') for method in methods]
+        chrom_names = chroms[0].cat.categories
+        for chrom in chroms[1:]:
+            chrom_names = chrom_names.union(chrom.cat.categories)
+        chrom_names = chrom_names.sort_values()
+        codes = []
+        for chrom in chroms:
+            chrom_codes = chrom.cat.codes.to_numpy()
+            # The extra -1 at the end keeps a missing chromosome's -1 code as -1
+            remap = np.append(chrom_names.get_indexer(chrom.cat.categories), -1)
+            codes.append(remap[chrom_codes])
+        codes = np.concatenate(codes)
         
-        consensus_df = pd.DataFrame(consensus, columns = columns)
-        consensus_df = consensus_df.drop_duplicates()
+        # Combine chromosome and position into one int64 key. The stride keeps positions on
+        # different chromosomes more than distance apart, so a single sorted array covers all of them.
+        # Calls without a chromosome can't match anything, so they are left out.
+        all_pos = pd.concat([all_dict[method]['POS'] for method in methods]).to_numpy().astype(np.int64)
+        all_methods = np.repeat(np.arange(len(methods)), [all_dict[method].shape[0] for method in methods])
+        has_chrom = codes >= 0
+        codes, all_pos, all_methods = codes[has_chrom], all_pos[has_chrom], all_methods[has_chrom]
+        stride = (all_pos.max() if all_pos.size > 0 else 0) + distance + 1
+        all_keys = codes.astype(np.int64) * stride + all_pos
         
-        consensus_df = consensus_df.sort_values(by='CHROM', ascending=True)
+        # Sort the calls of every method together
+        order = np.argsort(all_keys, kind='stable')
+        sorted_keys = all_keys[order]
+        sorted_pos = all_pos[order]
+        sorted_chrom = codes[order]
+        sorted_methods = all_methods[order]
+        
+        # Two calls within the distance are linked, and in sorted order every call in between is
+        # linked to both, so the linked groups are the runs without a gap larger than the distance.
+        # This is the union-find over all the calls, without having to build the edges.
+        breaks = np.flatnonzero(np.diff(sorted_keys) > distance) + 1
+        group_starts = np.concatenate(([0], breaks)) if sorted_keys.size > 0 else breaks
+        group_sizes = np.diff(np.append(group_starts, sorted_keys.size))
+        group = np.repeat(np.arange(group_starts.size), group_sizes)
+        
+        # Count the distinct methods in every group
+        present = np.zeros((group_starts.size, len(methods)), dtype=bool)
+        present[group, sorted_methods] = True
+        counts = present.sum(axis=1)
+        keep = np.flatnonzero(counts >= agreement)
+        
+        # The average is the mean of every position in the group
+        avg_out = np.add.reduceat(sorted_pos, group_starts)[keep] // group_sizes[keep]
+        chrom_out = sorted_chrom[group_starts[keep]]
+        
+        # Within each method the groups are contiguous too, so each kept group is a
+        # [lo, hi) window into that method's sorted positions.
+        sorted_pos_dict = {}
+        lo_out = np.empty((keep.size, len(methods)), dtype=np.int64)
+        hi_out = np.empty((keep.size, len(methods)), dtype=np.int64)
+        for method, storage_pos in pos_col_dict.items():
+            in_method = sorted_methods == storage_pos
+            sorted_pos_dict[method] = sorted_pos[in_method]
+            lo_out[:, storage_pos] = np.searchsorted(group[in_method], keep, side='left')
+            hi_out[:, storage_pos] = np.searchsorted(group[in_method], keep, side='right')
+        
+        # Only now turn the windows into tuples of positions, with -1 for methods without a match
+        consensus_df = pd.DataFrame({'CHROM': chrom_names[chrom_out]})
+        for method, storage_pos in pos_col_dict.items():
+            consensus_df[method] = pd.Series(
+                [tuple(sorted_pos_dict[method][l:h].tolist()) if h > l else -1
+                 for l, h in zip(lo_out[:, storage_pos], hi_out[:, storage_pos])],
+                dtype=object)
+        consensus_df['AVERAGE'] = avg_out
+        
+        # The groups were built from the sorted keys, so the rows are already ordered by chromosome and position
         
         return consensus_df
                     
 
-class file:
+@dataclass(slots=True)
+class File:
     """
-    A class to represent a file with specific attributes and methods.
+    A class to represent a file with specific attributes.
+    Uses slots, so instances carry no per-instance __dict__.
 
     Attributes:
     -----------
@@ -140,64 +204,83 @@ class file:
             The condition associated with the file.
         df : DataFrame
             The DataFrame associated with the file.
-
-    Methods:
-    --------
-        __init__(self, path, method, condition, df)
-            Initializes the file with the given path, method, condition, and DataFrame.
     """
-    def __init__(self, path, method, condition, df):
-        self.method = method
-        self.condition = condition
-        self.path = path
-        self.df = df
+    path: str
+    method: str
+    condition: str
+    df: pd.DataFrame
         
         
+def read_calls(file_path) -> pd.DataFrame:
+    """
+    Reads a single CSV of calls, dropping the empty rows some callers write and any row without a
+    position, since it could never match. The position column ('POS', or 'left_pos' for seekSV) is
+    cast to int32, or int64 if a position doesn't fit, and the chromosome column ('#CHROM', or
+    '@left_chr') to a categorical, so chromosomes can be compared as int codes.
+    Args:
+        file_path (str): The path to the CSV file.
+    Returns:
+        pd.DataFrame: The DataFrame containing the data from the CSV file.
+    """
+    df = pd.read_csv(file_path)
+    pos_col = 'POS' if 'POS' in df.columns else 'left_pos'
+    df = df.dropna(subset=[pos_col])
+    pos_dtype = 'int64' if df[pos_col].max() > np.iinfo(np.int32).max else 'int32'
+    df[pos_col] = df[pos_col].astype(pos_dtype)
+    chrom_col = '#CHROM' if '#CHROM' in df.columns else '@left_chr'
+    df[chrom_col] = df[chrom_col].astype('category')
+    return df
+
+
 def get_data(directory):
     """
     Reads CSV files from a specified directory, extracts method and condition from filenames,
-    and returns a list of file objects containing the file path, method, condition, and DataFrame.
+    and returns a list of File objects containing the file path, method, condition, and DataFrame.
     Args:
         directory (str): The path to the directory containing the CSV files.
     Returns:
-        list: A list of file objects, each containing:
+        list: A list of File objects, each containing:
             - file_path (str): The path to the CSV file.
             - method (str): The method extracted from the filename.
             - condition (str): The condition extracted from the filename.
             - df (pd.DataFrame): The DataFrame containing the data from the CSV file.
     """
-    files = []
+    found = []
     
     # Iterate over the files in the directory
     for filename in os.listdir(directory):
-        # Check if the file is a CSV file
-        if filename.endswith('.csv'):
-            # Extract the method and condition from the filename
-            method = re.search(r'(?<=_).+(?=.csv)', filename).group(0)
-            condition = re.search(r'.+(?=_)', filename).group(0)
-            
-            # print(f'File Name: {filename}, Method: {method}, Condition: {condition}')
+        # Check if the file is a CSV file, and extract the method and condition from the filename
+        match = FILENAME_RE.match(filename)
+        if not match:
+            continue
+        method, condition = match.group('method'), match.group('condition')
+        
+        # print(f'File Name: {filename}, Method: {method}, Condition: {condition}')
 
-            file_path = os.path.join(directory, filename)
-            df = pd.read_csv(file_path)
-            
-            files.append(file(file_path, method, condition, df))
+        file_path = os.path.join(directory, filename)
+        found.append((file_path, method, condition))
+    
+    # Read the CSVs in parallel, the C parser releases the GIL while it works
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        dfs = list(executor.map(read_calls, [file_path for file_path, _, _ in found]))
+    
+    files = [File(file_path, method, condition, df) for (file_path, method, condition), df in zip(found, dfs)]
             
     return files
             
 def filter(files):
     """
-    Filters a list of file objects based on specific criteria.
-    This function iterates over a list of file objects and filters out those
+    Filters a list of File objects based on specific criteria.
+    This function iterates over a list of File objects and filters out those
     whose 'method' attribute is 'seekSV'. For the remaining files, it further
     filters the DataFrame (df attribute) to include only rows where the 'FILTER'
-    column has the value 'PASS'. The filtered file objects are then returned.
+    column has the value 'PASS'. The filtered File objects are then returned.
     Args:
-        files (list): A list of file objects. Each file object is expected to have
+        files (list): A list of File objects. Each File object is expected to have
                       a 'method' attribute and a 'df' attribute, where 'df' is a
                       pandas DataFrame.
     Returns:
-        list: A list of filtered file objects.
+        list: A list of filtered File objects.
     """
     
     filtered_files = []
@@ -207,7 +290,7 @@ def filter(files):
         # For now, we are only interested in files that are not seekSV
         if file.method != 'seekSV':
             # Filter out rows with quality flags
-            df = df[(df['FILTER'] == 'PASS') | (df['FILTER'] == '.')]
+            df = df.iloc[np.isin(df['FILTER'].to_numpy(), ('PASS', '.'))]
             file.df = df
             filtered_files.append(file)
             if file.df.empty == False: